@@ -1,5 +1,6 @@
 
 import os
+import threading
 import platform
 if platform.python_version_tuple()[0] == '2':
     from StringIO import StringIO
@@ -8,6 +9,23 @@ else:
     from io import StringIO
     from configparser import ConfigParser, NoOptionError
 
+# orjson is much faster than the stdlib encoder.  Both helpers work in bytes so callers can
+# write the result straight to a socket or file
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    json_loads = json.loads
+
 
 
 class AlprProcessorConfig():
@@ -19,8 +37,10 @@ class AlprProcessorConfig():
         CUR_DIR = os.path.dirname(os.path.realpath(__file__))
         self.config_file = os.path.join(CUR_DIR, '../config/', 'import_config.ini')
         self.camera_config = {}
+        self._camera_config_lock = threading.Lock()
 
-        parser = self._get_parser()
+        self._parser = self._get_parser()
+        parser = self._parser
 
         self.server = parser.get(self.default_section_name, 'database_server')
         self.user = parser.get(self.default_section_name, 'database_user')
@@ -41,6 +61,11 @@ class AlprProcessorConfig():
         self.openalpr_url = parser.get(self.default_section_name, 'openalpr_url')
         self.upload_timeout = float(parser.get(self.default_section_name, 'upload_timeout'))
 
+        try:
+            self.processing_threads = int(parser.get(self.default_section_name, 'processing_threads'))
+        except NoOptionError:
+            self.processing_threads = None
+
     def _get_parser(self):
 
         parser = ConfigParser()
@@ -55,14 +80,20 @@ class AlprProcessorConfig():
 
     def get_camera_config(self, camera_name):
 
-        parser = self._get_parser()
-
         # Cache the lookups
-        if camera_name not in self.camera_config:
-           self.camera_config[camera_name] = {
-               'camera_id': parser.get(camera_name, 'camera_id'),
-               'gps_latitude': parser.get(camera_name, 'gps_latitude'),
-               'gps_longitude': parser.get(camera_name, 'gps_longitude')
-           }
-
-        return self.camera_config[camera_name]
\ No newline at end of file
+        try:
+            return self.camera_config[camera_name]
+        except KeyError:
+            pass
+
+        # The config is shared across the processing threads
+        with self._camera_config_lock:
+            if camera_name not in self.camera_config:
+                parser = self._parser
+                self.camera_config[camera_name] = {
+                    'camera_id': parser.get(camera_name, 'camera_id'),
+                    'gps_latitude': parser.get(camera_name, 'gps_latitude'),
+                    'gps_longitude': parser.get(camera_name, 'gps_longitude')
+                }
+
+            return self.camera_config[camera_name]
\ No newline at end of file
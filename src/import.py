@@ -8,9 +8,12 @@ import socket
 import datetime
 import json
 import time
+import threading
+from queue import Queue
 import pytz
 import logging
-from alprcommon import AlprProcessorConfig
+from collections import defaultdict
+from alprcommon import AlprProcessorConfig, json_loads
 from logging.handlers import RotatingFileHandler
 from logging import StreamHandler
 from openalprprocessor import OpenALPRProcessor
@@ -21,18 +24,22 @@ state_file = os.path.join(CUR_DIR, '../config/', 'state.json')
 log_file = os.path.join(CUR_DIR, '../log/', 'import.log')
 logger = logging.getLogger('import_logger')
 
+# Keyset paging on read_date.  pytds sends parameterized queries through sp_executesql, so SQL Server
+# caches this plan and reuses it for every page as long as the text stays identical
+READS_PAGE_QUERY = 'SELECT TOP 1000 read_id, plate, device_id, read_date, lat, lon FROM reads WHERE read_date > %s ORDER BY read_date ASC'
+
 
 def _datetime_to_epochms( dt, tzinfo=pytz.utc):
-    epoch = datetime.datetime.utcfromtimestamp(0)
-    if tzinfo is not None:
-        epoch = epoch.replace(tzinfo=tzinfo)
-    return int((dt - epoch).total_seconds() * 1000)
+    # Naive datetimes are taken to be in tzinfo (UTC if not given)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tzinfo or pytz.utc)
+    return int(dt.timestamp() * 1000)
 
 
 def _epochms_to_datetime( epoch_ms, tzinfo=pytz.utc):
-    datestamp = datetime.datetime.utcfromtimestamp(float(epoch_ms) / 1000.0)
-    if tzinfo is not None:
-        datestamp = datestamp.replace(tzinfo=pytz.utc)
+    datestamp = datetime.datetime.fromtimestamp(float(epoch_ms) / 1000.0, tz=pytz.utc)
+    if tzinfo is None:
+        datestamp = datestamp.replace(tzinfo=None)
     return datestamp
 
 ## last_parse corresponds to the current
@@ -41,19 +48,56 @@ class ParsingState:
         self.state = None
         try:
             if os.path.isfile(state_file):
-                with open(state_file, 'r') as inf:
-                    self.state = json.load(inf)
+                with open(state_file, 'rb') as inf:
+                    raw = inf.read()
+                if raw:
+                    self.state = json_loads(raw)
         except:
             pass
 
         if self.state is None:  
             self.state = {'version': 1, 'last_parse': 0, 'last_save': 0}
 
+        # last_save changes on every write, so progress is tracked by last_parse alone
+        self._saved_last_parse = self.state['last_parse']
+
+        # Writes happen on a background thread so the database loop never waits on disk
+        self._write_queue = Queue()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
     def save(self):
+        # _saved_last_parse only moves once a write succeeds, so a failed write is retried on the next save
+        if self.state['last_parse'] == self._saved_last_parse:
+            return
+
         self.state['last_save'] = _datetime_to_epochms(datetime.datetime.now(tz=pytz.utc), tzinfo=pytz.utc)
         self.state['version'] = 1
-        with open(state_file, 'w') as outf:
-            json.dump(self.state, outf, indent=2)
+        self._write_queue.put((self.state['last_parse'], json.dumps(self.state, indent=2).encode('utf-8')))
+
+    def close(self):
+        # Finish any queued writes before the process exits
+        self._write_queue.put(None)
+        self._writer.join()
+
+    def _write_loop(self):
+        tmp_file = state_file + '.tmp'
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+
+            last_parse, data = item
+            try:
+                # Write to a temp file and swap it in, so a crash never leaves a truncated state file
+                with open(tmp_file, 'wb') as outf:
+                    outf.write(data)
+                os.replace(tmp_file, state_file)
+                self._saved_last_parse = last_parse
+            except (IOError, OSError) as e:
+                logger.exception(e)
+                logger.warn("Unable to save parsing state to %s", state_file)
 
     def get_last_parse(self):
         return _epochms_to_datetime( self.state['last_parse'], True )
@@ -66,7 +110,7 @@ class ParsingState:
 
 class ElsagInterface:
 
-    def __init__(self, server, user, password, database_name, port, base_image_path):
+    def __init__(self, server, user, password, database_name, port, base_image_path, config=None):
         self.server = server
         self.user = user
         self.password = password
@@ -76,47 +120,37 @@ class ElsagInterface:
 
         self.parsing_state = ParsingState()
 
-        self.openalpr_processor = OpenALPRProcessor()
+        self.openalpr_processor = OpenALPRProcessor(config=config)
 
 
-    def process_read(self, conn, read_id, plate, camera, read_date, lat, lng):
+    def process_read(self, read_id, plate, camera, read_date, lat, lng, images):
         # we have a single read, grab all the image data and process it
-        logger.debug("Processing {read_id} on {read_date}".format(read_id=read_id, read_date=read_date))
+        logger.debug("Processing %s on %s", read_id, read_date)
 
         overview_image_path = None
         crop_image_path = None
 
-        with conn.cursor() as cursor:
-            OVERVIEW_IMAGE_ID = 1
-            CROP_IMAGE_ID = 2
-
-            cursor.execute('SELECT image_id, create_date, read_date, plate_image_type FROM images WHERE read_id = %s', (read_id,))
-
-            # "Getting all images"
-            results = cursor.fetchall()
-
-            for row in results:
-                image_id = row[0]
-                create_date = row[1]
-                read_date = row[2]
-                plate_image_type = int(row[3])
-                if plate_image_type == OVERVIEW_IMAGE_ID:
-                    overview_image_path = os.path.join(self.base_image_path, str(image_id))
-                elif plate_image_type == CROP_IMAGE_ID:
-                    crop_image_path = os.path.join(self.base_image_path, str(image_id))
-
-            logger.debug("Processing images.  Overview: %s  Crop: %s" % (overview_image_path, crop_image_path))
-            for img in [overview_image_path, crop_image_path]:
-                if img is None:
-                    logger.warn("Failed to find image for read_id {read_id} in database".format(read_id=read_id))
-                    return
-                if not os.path.isfile(img):
-                    logger.warn("Unable to find image {img} on disk for read_id {read_id}".format(img=img, read_id=read_id))
-                    return
-
-            # Load the images and process them
-            logger.debug("Found crop image {crop_image_path}".format(crop_image_path=crop_image_path))
-            logger.debug("Found overview image {overview_image_path}".format(overview_image_path=overview_image_path))
+        OVERVIEW_IMAGE_ID = 1
+        CROP_IMAGE_ID = 2
+
+        for image_id, plate_image_type in images:
+            plate_image_type = int(plate_image_type)
+            if plate_image_type == OVERVIEW_IMAGE_ID:
+                overview_image_path = os.path.join(self.base_image_path, str(image_id))
+            elif plate_image_type == CROP_IMAGE_ID:
+                crop_image_path = os.path.join(self.base_image_path, str(image_id))
+
+        logger.debug("Processing images.  Overview: %s  Crop: %s", overview_image_path, crop_image_path)
+        for img in [overview_image_path, crop_image_path]:
+            if img is None:
+                logger.warn("Failed to find image for read_id %s in database", read_id)
+                return
+
+        # The crop is opened by the processing thread, which reports it if missing.  The overview is
+        # never read, so stat it here
+        if not os.path.isfile(overview_image_path):
+            logger.warn("Unable to find image %s on disk for read_id %s", overview_image_path, read_id)
+            return
 
         read_epoch = read_date
         self.openalpr_processor.process(camera, _datetime_to_epochms(read_epoch), crop_image_path, overview_image_path, lat, lng)
@@ -124,6 +158,20 @@ class ElsagInterface:
         # Parsing with OpenALPR
         # We have two images, do the LPR processing on one and the 
 
+    def get_images(self, cursor, read_ids):
+        # Grab the images for a whole page of reads in one round-trip
+        images_by_read = defaultdict(list)
+
+        placeholders = ', '.join(['%s'] * len(read_ids))
+        cursor.execute('SELECT read_id, image_id, plate_image_type FROM images WHERE read_id IN (%s)' % placeholders, tuple(read_ids))
+        for row in cursor.fetchall():
+            images_by_read[row[0]].append((row[1], row[2]))
+
+        return images_by_read
+
+    def close(self):
+        self.parsing_state.close()
+
     def run(self):
 
         while True:
@@ -142,21 +190,23 @@ class ElsagInterface:
                         with conn.cursor() as cursor:
 
                             last_parse = self.parsing_state.get_last_parse()
-                            logger.debug( "Last parse: " + str(last_parse))
+                            logger.debug("Last parse: %s", last_parse)
 
-                            #cursor.execute('SELECT read_id, plate, device_id, read_date, lat, lon FROM reads WHERE read_date > 2010-01-01 ORDER BY read_date asc LIMIT 1000')
-                            cursor.execute('SELECT TOP 1000 read_id, plate, device_id, read_date, lat, lon FROM reads WHERE read_date > %s ORDER BY read_date ASC', (last_parse,))
+                            cursor.execute(READS_PAGE_QUERY, (last_parse,))
 
 
                             results = cursor.fetchall()
 
                             if len(results) == 0:
-                                # No results, sleep for a while
+                                # No results, sleep for a while.  Retries the checkpoint if the last write failed
+                                self.parsing_state.save()
                                 logger.debug ("No results.  Sleeping...")
                                 time.sleep(5)
                                 continue
 
                             logger.info("Grabbed {count} results from db starting from time: {time}".format(count=len(results), time=last_parse))
+                            images_by_read = self.get_images(cursor, [row[0] for row in results])
+
                             for row in results:
                                 read_id = row[0]
                                 plate = row[1]
@@ -168,9 +218,7 @@ class ElsagInterface:
                                 if read_date > last_parse:
                                     self.parsing_state.set_last_parse(read_date)
 
-                                self.process_read(conn, read_id, plate, camera, read_date, lat, lng)
-
-                                # Now select each image for the given row
+                                self.process_read(read_id, plate, camera, read_date, lat, lng, images_by_read[read_id])
 
                             self.parsing_state.save()
 
@@ -218,6 +266,9 @@ if __name__ == "__main__":
     elsag = ElsagInterface(proc_config.server, 
         proc_config.user, proc_config.password, 
         proc_config.database_name, proc_config.port,
-        proc_config.base_image_path)
+        proc_config.base_image_path, config=proc_config)
 
-    elsag.run()
\ No newline at end of file
+    try:
+        elsag.run()
+    finally:
+        elsag.close()
\ No newline at end of file
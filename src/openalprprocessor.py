@@ -3,14 +3,15 @@ from openalpr import Alpr
 from vehicleclassifier import VehicleClassifier
 import os
 import threading
+import itertools
 from argparse import ArgumentParser
 import time
 import multiprocessing
-import copy
 import json
 import logging
-from alprcommon import AlprProcessorConfig
+from alprcommon import AlprProcessorConfig, json_dumps
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 from PIL import Image
 import platform
@@ -20,37 +21,51 @@ import sys
 if platform.python_version_tuple()[0] == '2':
     _PYTHON_3=False
     from StringIO import StringIO
-    from Queue import Queue, Empty
+    from Queue import Queue
 else:
     _PYTHON_3=True
     from io import BytesIO
-    from queue import Queue, Empty
+    from queue import Queue
 
-threadLock = threading.Lock()
-thread_count = 0
+# next() on itertools.count is atomic under the GIL, so no lock is needed to number the threads
+thread_counter = itertools.count()
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 logger = logging.getLogger('import_logger')
 
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
 class PlateUploader():
     def __init__(self, config):
         with open(os.path.join(SCRIPT_DIR, '../config/', 'group.template'), 'r') as inf:
-            self.group_template = json.load(inf)
+            group_template = json.load(inf)
 
         self.config = config
-        self.group_template['company_id'] = self.config.company_id
-        self.group_template['agent_uid'] = self.config.agent_uid
+
+        # Fields that are identical for every upload.  Per-plate values are filled in by upload()
+        del group_template['vehicle']
+        group_template['company_id'] = self.config.company_id
+        group_template['agent_uid'] = self.config.agent_uid
+        self._static = group_template
 
         self.url = config.openalpr_url
         self.timeout = config.upload_timeout
 
-    def upload(self, curplate, plate_results, vehicle_results, plate_crop_jpeg_bytes, vehicle_crop_jpeg_bytes):
-        upload_template = copy.copy(self.group_template)
+        # The push endpoint takes one group per POST, so there is no batching here.  Keep connections
+        # alive between uploads instead, rather than doing a new TCP/TLS handshake per plate
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
+    def upload(self, curplate, plate_results, vehicle_results, plate_crop_jpeg_bytes, vehicle_crop_jpeg_bytes):
         camera_name = curplate['camera_name']
         epoch_time = curplate['epoch_time']
-        
+
+        camera_config = self.config.get_camera_config(camera_name.upper())
+        camera_id = camera_config['camera_id']
+
         if curplate['lat'] != None and curplate['lng'] != None:
             gps_latitude = curplate['lat']
             gps_longitude = curplate['lng']
@@ -58,45 +73,40 @@ class PlateUploader():
             gps_latitude = camera_config['gps_latitude']
             gps_longitude = camera_config['gps_longitude']
             
-        # print(plate_results)
         best_plate = plate_results['results'][0]
-        del upload_template['vehicle']
-        # upload_template['vehicle'] = vehicle_results
-        upload_template['best_plate'] = best_plate
-        upload_template['best_plate']['plate_crop_jpeg'] = plate_crop_jpeg_bytes
-
-        camera_config = self.config.get_camera_config(camera_name.upper())
-        camera_id = camera_config['camera_id']
+        best_plate['plate_crop_jpeg'] = plate_crop_jpeg_bytes
 
         uuid = '%s-%s-%s' % ( self.config.agent_uid, camera_id, epoch_time)
-        upload_template['best_uuid'] = uuid
-        upload_template['uuids'].append(uuid)
-        upload_template['camera_id'] = camera_id
-        upload_template['camera_name'] = camera_name
-        upload_template['gps_latitude'] = gps_latitude
-        upload_template['gps_longitude'] = gps_longitude
 
-        upload_template['epoch_start'] = epoch_time
-        upload_template['epoch_end'] = epoch_time
-
-        upload_template['best_plate_number'] = best_plate['plate']
-        upload_template['best_confidence'] = best_plate['confidence']
-
-        upload_template['best_region_confidence'] = best_plate['region_confidence']
-        upload_template['best_region'] = best_plate['region']
-
-        upload_template['candidates'] = best_plate['candidates']
+        upload_template = dict(self._static)
+        upload_template.update({
+            'best_uuid': uuid,
+            'uuids': [uuid],
+            'camera_id': camera_id,
+            'camera_name': camera_name,
+            'gps_latitude': gps_latitude,
+            'gps_longitude': gps_longitude,
+            'epoch_start': epoch_time,
+            'epoch_end': epoch_time,
+            'best_plate': best_plate,
+            'best_plate_number': best_plate['plate'],
+            'best_confidence': best_plate['confidence'],
+            'best_region_confidence': best_plate['region_confidence'],
+            'best_region': best_plate['region'],
+            'candidates': best_plate['candidates'],
+        })
+        # upload_template['vehicle'] = vehicle_results
         #upload_template['vehicle_crop_jpeg'] = vehicle_crop_jpeg_bytes
 
-        #logger.debug(json.dumps(upload_template, indent=2))
-        logger.info("uploading plate " + best_plate['plate'])
-        # print json.dumps(upload_template, indent=2)
+        logger.info("uploading plate %s", best_plate['plate'])
+        payload = json_dumps(upload_template)
+
         # Upload to webserver
         while True:
-            logger.debug("Posting to %s" % (self.url))
-            r = requests.post(self.url, json=upload_template, timeout=self.timeout, verify=False)
+            logger.debug("Posting to %s", self.url)
+            r = self.session.post(self.url, data=payload, headers=JSON_HEADERS, timeout=self.timeout, verify=False)
 
-            logger.info('Webserver POST status {}: {}'.format(r.status_code, r.text))
+            logger.info('Webserver POST status %s: %s', r.status_code, r.text)
 
             if str(r.status_code)[0] == '2':
                 break
@@ -108,19 +118,14 @@ class PlateUploader():
 
 class PlateProcessorThread (threading.Thread):
 
-    def __init__(self, plate_queue, country='us'):
+    def __init__(self, plate_queue, config, country='us'):
         threading.Thread.__init__(self)
         self.plate_queue = plate_queue
-        self.active = True
+        self.config = config
         self.country = country
 
+    def _resize_img(self, x,y,w,h, new_width, img):
 
-    def deactivate(self):
-        self.active = False
-
-    def _resize_img(self, x,y,w,h, new_width, image_path):
-
-        img = Image.open(image_path)
         img_shape = img.size
         if x < 0:
             x = 0
@@ -134,73 +139,57 @@ class PlateProcessorThread (threading.Thread):
         cropped = img.crop((x,y,w+x,h+y))
         wpercent = (new_width / float(cropped.size[0]))
         hsize = int((float(cropped.size[1]) * float(wpercent)))
-        img = cropped.resize((new_width, hsize), Image.ANTIALIAS)
+        img = cropped.resize((new_width, hsize), Image.BILINEAR)
         #img.save('sompic.jpg')
         if _PYTHON_3:
             buffer = BytesIO()
         else:
             buffer = StringIO()
         img.save(buffer, format="JPEG")
+        # The push endpoint only accepts JSON, so the crop has to travel base64 encoded
         img_str = base64.b64encode(buffer.getvalue()).decode("utf-8")
 
         return img_str
 
     def run(self):
-        global threadLock, thread_count
-
         # Parser config bypasses detection on crop
         parser_config = os.path.join(SCRIPT_DIR, '../config/', "openalprparser.conf")
         self.alpr = Alpr(self.country, "", "")
         #self.vehicle_classifier = VehicleClassifier("","")
 
-        config = AlprProcessorConfig()
-        plate_uploader = PlateUploader(config)
+        plate_uploader = PlateUploader(self.config)
 
         if not self.alpr.is_loaded():
             logger.warn("Alpr instance loaded")
 
-        threadLock.acquire()
-        self.thread_number = thread_count
+        self.thread_number = next(thread_counter)
         logger.info("Initiating thread #%d" % (self.thread_number))
-        thread_count += 1
-        threadLock.release()
-
-        while self.active:
 
-            curplate = None
-            threadLock.acquire()
-            try:
-                curplate = self.plate_queue.get(block=False)
-            except Empty:
-                curplate = None
-            threadLock.release()
+        while True:
 
+            # Block until there is a plate to process.  close() queues a None for each thread to stop it
+            curplate = self.plate_queue.get()
             if curplate is None:
-                # No plate to process, sleep and continue
-                time.sleep(0.25)
-                continue
+                break
 
-            # We have a plate to process, let's do it
-            plate_results = self.alpr.recognize_file(curplate['crop_image'])
+            # We have a plate to process, let's do it.  Read the crop once and reuse the bytes for
+            # both recognition and the thumbnail
+            try:
+                with open(curplate['crop_image'], 'rb') as inf:
+                    crop_image_bytes = inf.read()
+            except (IOError, OSError):
+                logger.warn("Unable to find image %s on disk", curplate['crop_image'])
+                continue
+            plate_results = self.alpr.recognize_array(crop_image_bytes)
 
-            #import json
-            #print(json.dumps( plate_results, indent=2))
-            # print plate_results
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("plate_results=%s", json.dumps(plate_results))
             if len(plate_results['results']) > 0:
                 plate_coords = plate_results['results'][0]['coordinates']
-                min_x = plate_coords[0]['x']
-                max_x = plate_coords[0]['x']
-                min_y = plate_coords[0]['y']
-                max_y = plate_coords[0]['y']
-                for coord in plate_coords:
-                    if coord['x'] > max_x:
-                        max_x = coord['x']
-                    if coord['x'] < min_x:
-                        min_x = coord['x']
-                    if coord['y'] > max_y:
-                        max_y = coord['y']
-                    if coord['y'] < min_y:
-                        min_y = coord['y']
+                xs = [coord['x'] for coord in plate_coords]
+                ys = [coord['y'] for coord in plate_coords]
+                min_x, max_x = min(xs), max(xs)
+                min_y, max_y = min(ys), max(ys)
 
                 x = min_x
                 y = min_y
@@ -215,7 +204,11 @@ class PlateProcessorThread (threading.Thread):
                 width += adjust_x
                 height += adjust_y
 
-                plate_crop_encoded = self._resize_img( x,y,width,height, 150, curplate['crop_image'])
+                if _PYTHON_3:
+                    crop_img = Image.open(BytesIO(crop_image_bytes))
+                else:
+                    crop_img = Image.open(StringIO(crop_image_bytes))
+                plate_crop_encoded = self._resize_img( x,y,width,height, 150, crop_img)
 
                 # Skip vehicles for now.  In version 2.8.101 the vehicle detector can be used to scan / recognize the overview image
 
@@ -228,19 +221,31 @@ class PlateProcessorThread (threading.Thread):
 
                 plate_uploader.upload(curplate, plate_results, vehicle_results, plate_crop_encoded, vehicle_crop_encoded )
 
+# Threads rather than processes: Alpr is called through ctypes, which drops the GIL for the duration of
+# the native call, and Pillow releases it while decoding/resampling/encoding.  The Python work left per
+# plate is small, so threads scale without the spawn and pickling costs of a process pool on Windows.
 class OpenALPRProcessor():
-    def __init__(self, num_threads=multiprocessing.cpu_count()):
-        if num_threads > 8:
-            num_threads = 8
-        # Initialize the lib
-        self.queue = Queue()
+    def __init__(self, num_threads=None, config=None):
+        # One config shared by all threads, so the camera lookups are cached once
+        if config is None:
+            config = AlprProcessorConfig()
+        self.config = config
+
+        # Alpr instances are not thread-safe, so every thread holds its own (and its own copy of the
+        # models).  The thread count is what bounds memory
+        if num_threads is None:
+            num_threads = config.processing_threads or multiprocessing.cpu_count()
+        # Always start at least one worker, or process() would block forever once the queue fills
+        num_threads = max(1, min(num_threads, 8))
 
+        # Initialize the lib.  put() blocks once the queue is full
         self.max_queue_size = num_threads * 3
+        self.queue = Queue(maxsize=self.max_queue_size)
 
         self.threads = []
         for thread in range(0, num_threads):
 
-            t = PlateProcessorThread(self.queue)
+            t = PlateProcessorThread(self.queue, self.config)
             t.daemon = True
             t.start()
             self.threads.append(t)
@@ -249,9 +254,6 @@ class OpenALPRProcessor():
 
     ''' Process the image files and provide the JSON'''
     def process(self, camera_name, epoch_time, crop_image, overview_image, lat=None, lng=None):
-        global threadLock
-
-        threadLock.acquire()
         self.queue.put({
             "camera_name": camera_name,
             "epoch_time": epoch_time,
@@ -260,15 +262,10 @@ class OpenALPRProcessor():
             "lat": lat,
             "lng": lng
             })
-        threadLock.release()
-
-        # Block on large queue size
-        while self.queue.qsize() >= self.max_queue_size:
-            time.sleep(0.1)
 
     def close(self):
         for t in self.threads:
-            t.deactivate()
+            self.queue.put(None)
 
     def join(self):
         for t in self.threads:
@@ -1,38 +1,43 @@
+import collections
 import ctypes
-import json
-import platform
+import sys
+import threading
+import weakref
 import numpy as np
 import numpy.ctypeslib as npct
 
-
-# We need to do things slightly differently for Python 2 vs. 3
-# ... because the way str/unicode have changed to bytes/str
-if platform.python_version_tuple()[0] == '2':
-    # Using Python 2
-    bytes = str
-    _PYTHON_3 = False
-else:
-    # Assume using Python 3+
-    unicode = str
-    _PYTHON_3 = True
+# orjson decodes the classifier's JSON responses several times faster than the stdlib
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
 
 
 def _convert_to_charp(string):
     # Prepares function input for use in c-functions as char*
-    if type(string) == unicode:
+    try:
         return string.encode("UTF-8")
-    elif type(string) == bytes:
-        return string
-    else:
+    except AttributeError:
+        if isinstance(string, bytes):
+            return string
         raise TypeError("Expected unicode string values or ascii/bytes values. Got: %r" % type(string))
 
 
 def _convert_from_charp(charp):
     # Prepares char* output from c-functions into Python strings
-    if _PYTHON_3 and type(charp) == bytes:
+    if isinstance(charp, bytes):
         return charp.decode("UTF-8")
-    else:
-        return charp
+    return charp
+
+# Result categories summarized by get_top_result, in output order
+_TOP_FIELDS = ('year', 'color', 'make_model', 'body_type', 'orientation')
+_DEG_FMT = '{} degrees'.format
+
+# Highest confidence name for each category, '' where the classifier had no result
+TopResults = collections.namedtuple('TopResults', _TOP_FIELDS)
+
+# Load the .dll for Windows and the .so for Unix-based
+_LIBNAME = {'win32': 'libopenalpr.dll', 'darwin': 'libopenalpr.dylib'}.get(sys.platform, 'libopenalpr.so.2')
 
 class VehicleClassifierCRegionOfInterest(ctypes.Structure):
     _fields_ = [("x",  ctypes.c_int),
@@ -40,7 +45,104 @@ class VehicleClassifierCRegionOfInterest(ctypes.Structure):
                 ("width", ctypes.c_int),
                 ("height", ctypes.c_int)]
 
+# Region of interest covering the whole image, used when the caller doesn't pass one
+_FULL_ROI = VehicleClassifierCRegionOfInterest(0, 0, 1000000, 1000000)
+
+_roi_local = threading.local()
+
+
+def _get_roi(x, y, width, height):
+    # The ROI is passed to C by value, so a per-thread structure can be refilled in place
+    # rather than constructing a new one on every call
+    if x is None or y is None or width is None or height is None:
+        return _FULL_ROI
+
+    roi = getattr(_roi_local, 'roi', None)
+    if roi is None:
+        roi = _roi_local.roi = VehicleClassifierCRegionOfInterest()
+    roi.x = x
+    roi.y = y
+    roi.width = width
+    roi.height = height
+    return roi
+
+_LibFunctions = collections.namedtuple('_LibFunctions', [
+    'lib', 'dispose', 'free_json_mem', 'get_version', 'is_loaded', 'initialize',
+    'recognize_file', 'recognize_array', 'recognize_raw_image', 'set_top_n'])
+
+
+def _bind_lib(libname):
+    # Load the library and declare the argument/return types once.  ctypes caches the function
+    # objects on the library, so this only needs to happen the first time it is used.
+    # This must stay a cdll (not pydll) load: CDLL functions release the GIL for the duration of the
+    # call, which lets other threads decode and upload while a recognition runs
+    try:
+        lib = ctypes.cdll.LoadLibrary(libname)
+    except OSError as e:
+        raise OSError("Unable to locate the OpenALPR Vehicle Classification library. Please make sure that it is properly "
+                      "installed on your system and that the libraries are in the appropriate paths.") from e
+
+    array_1_uint8 = npct.ndpointer(dtype=np.uint8, ndim=1, flags='CONTIGUOUS')
+
+    dispose = lib.vehicleclassifier_cleanup
+    dispose.argtypes = [ctypes.c_void_p]
+
+    free_json_mem = lib.vehicleclassifier_free_response_string
+    free_json_mem.argtypes = [ctypes.c_void_p]
+
+    get_version = lib.openalpr_get_version
+    get_version.argtypes = [ctypes.c_void_p]
+    get_version.restype = ctypes.c_void_p
+
+    is_loaded = lib.vehicleclassifier_is_loaded
+    is_loaded.argtypes = [ctypes.c_void_p]
+    is_loaded.restype = ctypes.c_bool
+
+    initialize = lib.vehicleclassifier_init
+    initialize.restype = ctypes.c_void_p
+    initialize.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_char_p]
+
+    recognize_file = lib.vehicleclassifier_recognize_imagefile
+    recognize_file.restype = ctypes.c_void_p
+    recognize_file.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+
+    recognize_array = lib.vehicleclassifier_recognize_encodedimage
+    recognize_array.restype = ctypes.c_void_p
+    # The image buffer is declared as char* (ABI-identical to the C uint8_t*) so bytes pass through without a cast
+    recognize_array.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint, VehicleClassifierCRegionOfInterest]
+
+    recognize_raw_image = lib.vehicleclassifier_recognize_rawimage
+    recognize_raw_image.restype = ctypes.c_void_p
+    recognize_raw_image.argtypes = [
+        ctypes.c_void_p, ctypes.c_char_p, array_1_uint8, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, VehicleClassifierCRegionOfInterest]
+
+    set_top_n = lib.vehicleclassifier_set_topn
+    set_top_n.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    return _LibFunctions(lib, dispose, free_json_mem, get_version, is_loaded, initialize,
+                         recognize_file, recognize_array, recognize_raw_image, set_top_n)
+
+
+_bound_libs = {}
+_bound_libs_lock = threading.Lock()
+
+
+def _get_lib(libname):
+    with _bound_libs_lock:
+        if libname not in _bound_libs:
+            _bound_libs[libname] = _bind_lib(libname)
+        return _bound_libs[libname]
+
+def _cleanup(dispose, pointer):
+    if pointer is not None:
+        dispose(pointer)
+
 class VehicleClassifier:
+    # Slots keep the per-call lookups of the hot native functions off the instance dict
+    __slots__ = ('use_gpu', 'vehicleclassifier_pointer', '_fns', '_country_enc', '_finalizer',
+                 '_recognize_file', '_recognize_array', '_recognize_raw_image', '_free_json_mem',
+                 '__weakref__')
+
     def __init__(self, config_file, runtime_dir, license_key="", use_gpu=False, gpu_id=0, gpu_batch_size=10):
         """
         Initializes an OpenALPR Vehicle Classifier instance in memory.
@@ -53,64 +155,24 @@ class VehicleClassifier:
         self.use_gpu = use_gpu
         config_file = _convert_to_charp(config_file)
         runtime_dir = _convert_to_charp(runtime_dir)
-        try:
-        # Load the .dll for Windows and the .so for Unix-based
-            if platform.system().lower().find("windows") != -1:
-                self._vehicleclassifierpy_lib = ctypes.cdll.LoadLibrary("libopenalpr.dll")
-            elif platform.system().lower().find("darwin") != -1:
-                self._vehicleclassifierpy_lib = ctypes.cdll.LoadLibrary("libopenalpr.dylib")
-            else:
-                self._vehicleclassifierpy_lib = ctypes.cdll.LoadLibrary("libopenalpr.so.2")
-        except OSError as e:
-            nex = OSError("Unable to locate the OpenALPR Vehicle Classification library. Please make sure that it is properly "
-                          "installed on your system and that the libraries are in the appropriate paths.")
-            if _PYTHON_3:
-                nex.__cause__ = e;
-            raise nex
-
-        array_1_uint8 = npct.ndpointer(dtype=np.uint8, ndim=1, flags='CONTIGUOUS')
-        
-        self._dispose_func = self._vehicleclassifierpy_lib.vehicleclassifier_cleanup
-        self._dispose_func.argtypes = [ctypes.c_void_p]
-
-        self._free_json_mem_func = self._vehicleclassifierpy_lib.vehicleclassifier_free_response_string
-
-        self._get_version_func = self._vehicleclassifierpy_lib.openalpr_get_version
-        self._get_version_func.argtypes = [ctypes.c_void_p]
-        self._get_version_func.restype = ctypes.c_void_p
-
-        self._is_loaded_func = self._vehicleclassifierpy_lib.vehicleclassifier_is_loaded
-        self._is_loaded_func.argtypes = [ctypes.c_void_p]
-        self._is_loaded_func.restype = ctypes.c_bool
-
-        self._initialize_func = self._vehicleclassifierpy_lib.vehicleclassifier_init
-        self._initialize_func.restype = ctypes.c_void_p
-        self._initialize_func.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_char_p]
-
-        self._recognize_file_func = self._vehicleclassifierpy_lib.vehicleclassifier_recognize_imagefile
-        self._recognize_file_func.restype = ctypes.c_void_p
-        self._recognize_file_func.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
-
-        self._recognize_array_func = self._vehicleclassifierpy_lib.vehicleclassifier_recognize_encodedimage
-        self._recognize_array_func.restype = ctypes.c_void_p
-        self._recognize_array_func.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_ubyte), ctypes.c_uint, VehicleClassifierCRegionOfInterest]
-
-        self._recognize_raw_image_func = self._vehicleclassifierpy_lib.vehicleclassifier_recognize_rawimage
-        self._recognize_raw_image_func.restype = ctypes.c_void_p
-        self._recognize_raw_image_func.argtypes = [
-            ctypes.c_void_p, ctypes.c_char_p, array_1_uint8, ctypes.c_uint, ctypes.c_uint, ctypes.c_uint, VehicleClassifierCRegionOfInterest]
+        # The library is bound with ctypes rather than a compiled extension so the importer can be
+        # installed from wheels alone
+        self._fns = _get_lib(_LIBNAME)
+        self._recognize_file = self._fns.recognize_file
+        self._recognize_array = self._fns.recognize_array
+        self._recognize_raw_image = self._fns.recognize_raw_image
+        self._free_json_mem = self._fns.free_json_mem
 
-        self._set_top_n_func = self._vehicleclassifierpy_lib.vehicleclassifier_set_topn
-        self._set_top_n_func.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        # Callers pass the same country code on every call, so keep its encoded form around
+        self._country_enc = {}
 
         if self.use_gpu:
-            self.vehicleclassifier_pointer = self._initialize_func(config_file, runtime_dir, 1, gpu_id, gpu_batch_size, _convert_to_charp(license_key))
+            self.vehicleclassifier_pointer = self._fns.initialize(config_file, runtime_dir, 1, gpu_id, gpu_batch_size, _convert_to_charp(license_key))
         else:
-            self.vehicleclassifier_pointer = self._initialize_func(config_file, runtime_dir, 0, 0, 1, _convert_to_charp(license_key))
-        
+            self.vehicleclassifier_pointer = self._fns.initialize(config_file, runtime_dir, 0, 0, 1, _convert_to_charp(license_key))
 
-    def __del__(self):
-        self.unload()
+        # Frees the native instance when this object is collected, unless unload() got there first
+        self._finalizer = weakref.finalize(self, _cleanup, self._fns.dispose, self.vehicleclassifier_pointer)
 
     def __enter__(self):
         return self
@@ -124,22 +186,44 @@ class VehicleClassifier:
         :param dict results: From ``recognize_*()`` methods.
         :return str vehicle_data: Highest confidence result.
         """
-        fields = ['year', 'color', 'make_model', 'body_type', 'orientation']
-        combined = []
-        for f in fields:
-            try:
-                combined.append(results[f][0]['name'])
-            except IndexError:
-                combined.append('')
-        combined = [c for c in combined if c != '']
+        combined = [c for c in self.top_results(results) if c]
         if len(combined) > 0:
             combined.insert(-1, 'oriented at')
-            combined[-1] = '{} degress'.format(combined[-1])
+            combined[-1] = _DEG_FMT(combined[-1])
             vehicle_data = ' '.join(combined)
         else:
             vehicle_data = ''
         return vehicle_data
 
+    def top_results(self, results):
+        """Extract the top result name for each JSON category.
+
+        :param dict results: From ``recognize_*()`` methods.
+        :return TopResults: Highest confidence name per category.
+        """
+        # Missing or empty categories yield '' without raising
+        return TopResults(*[(results.get(f) or [{}])[0].get('name', '') for f in _TOP_FIELDS])
+
+    def _encode_country(self, country):
+        encoded = self._country_enc.get(country)
+        if encoded is None:
+            encoded = _convert_to_charp(country)
+            if len(self._country_enc) < 16:
+                self._country_enc[country] = encoded
+        return encoded
+
+    def _take_string(self, ptr):
+        # Copy a string returned by the library and release the library's buffer
+        if not ptr:
+            raise RuntimeError("OpenALPR Vehicle Classifier returned no response")
+        try:
+            return ctypes.string_at(ptr)
+        finally:
+            self._free_json_mem(ptr)
+
+    def _finish_recognition(self, ptr):
+        return _loads(self._take_string(ptr))
+
     def get_version(self):
         """
         This gets the version of OpenALPR Vehicle Classifier
@@ -147,11 +231,8 @@ class VehicleClassifier:
         :return: Version information
         """
 
-        ptr = self._get_version_func(self.vehicleclassifier_pointer)
-        version_number = ctypes.cast(ptr, ctypes.c_char_p).value
-        version_number = _convert_from_charp(version_number)
-        self._free_json_mem_func(ctypes.c_void_p(ptr))
-        return version_number
+        ptr = self._fns.get_version(self.vehicleclassifier_pointer)
+        return _convert_from_charp(self._take_string(ptr))
 
     def is_loaded(self):
         """
@@ -159,7 +240,7 @@ class VehicleClassifier:
 
         :return: A bool representing if OpenALPR is loaded or not
         """
-        return self._is_loaded_func(self.vehicleclassifier_pointer)
+        return self._fns.is_loaded(self.vehicleclassifier_pointer)
 
     def recognize_file(self, country, file_path):
         """
@@ -170,41 +251,36 @@ class VehicleClassifier:
         :return: An OpenALPR analysis in the form of a response dictionary
         """
         file_path = _convert_to_charp(file_path)
-        country = _convert_to_charp(country)
-        ptr = self._recognize_file_func(self.vehicleclassifier_pointer, country, file_path)
-        json_data = ctypes.cast(ptr, ctypes.c_char_p).value
-        json_data = _convert_from_charp(json_data)
-        response_obj = json.loads(json_data)
-        self._free_json_mem_func(ctypes.c_void_p(ptr))
-        return response_obj
+        country = self._encode_country(country)
+        ptr = self._recognize_file(self.vehicleclassifier_pointer, country, file_path)
+        return self._finish_recognition(ptr)
 
     def recognize_array(self, country, byte_array, x=None, y=None, width=None, height=None):
         """
         This causes OpenALPR Vehicle Classifier to attempt to recognize an image passed in as a byte array.
 
-        :param byte_array: This should be a string (Python 2) or a bytes object (Python 3)
+        :param byte_array: A bytes, bytearray or memoryview object
         :return: An OpenALPR analysis in the form of a response dictionary
         """
-        country = _convert_to_charp(country)
-        if type(byte_array) != bytes:
-            raise TypeError("Expected a byte array (string in Python 2, bytes in Python 3)")
-        pb = ctypes.cast(byte_array, ctypes.POINTER(ctypes.c_ubyte))
-
-        if x == None or y == None or width == None or height == None:
-            x = 0
-            y = 0
-            width = 1000000
-            height = 1000000
-
-        roi = VehicleClassifierCRegionOfInterest(x, y, width, height)
+        country = self._encode_country(country)
+        if isinstance(byte_array, bytes):
+            buf = byte_array
+            size = len(byte_array)
+        elif isinstance(byte_array, (bytearray, memoryview)):
+            view = memoryview(byte_array)
+            size = view.nbytes
+            if view.readonly:
+                # ctypes can only borrow writable buffers
+                buf = view.tobytes()
+            else:
+                buf = (ctypes.c_char * size).from_buffer(view)
+        else:
+            raise TypeError("Expected a byte array (bytes, bytearray or memoryview)")
+        roi = _get_roi(x, y, width, height)
 
-        ptr = self._recognize_array_func(self.vehicleclassifier_pointer, country, pb, len(byte_array), roi)
+        ptr = self._recognize_array(self.vehicleclassifier_pointer, country, buf, size, roi)
 
-        json_data = ctypes.cast(ptr, ctypes.c_char_p).value
-        json_data = _convert_from_charp(json_data)
-        response_obj = json.loads(json_data)
-        self._free_json_mem_func(ctypes.c_void_p(ptr))
-        return response_obj
+        return self._finish_recognition(ptr)
 
 
     def recognize_ndarray(self, country, ndarray, x=None, y=None, width=None, height=None):
@@ -213,26 +289,24 @@ class VehicleClassifier:
         :param ndarray: numpy.array as used in cv2 module
         :return: An OpenALPR analysis in the form of a response dictionary
         """
-        height, width = ndarray.shape[:2]
-        bpp = ndarray.shape[2] if len(ndarray.shape) > 2 else 1
-
-        country = _convert_to_charp(country)
+        country = self._encode_country(country)
+        roi = _get_roi(x, y, width, height)
+        return self._recognize_raw(country, ndarray, roi)
 
-        if x == None or y == None or width == None or height == None:
-            x = 0
-            y = 0
-            width = 1000000
-            height = 1000000
+    def _recognize_raw(self, country, ndarray, roi):
+        if ndarray.dtype != np.uint8:
+            raise TypeError("Expected a uint8 image array. Got: %r" % ndarray.dtype)
 
-        roi = VehicleClassifierCRegionOfInterest(x, y, width, height)
+        shape = ndarray.shape
+        img_h = shape[0]
+        img_w = shape[1]
+        bpp = shape[2] if len(shape) > 2 else 1
 
-        ptr = self._recognize_raw_image_func(self.vehicleclassifier_pointer, country, ndarray.flatten(), bpp, width, height, roi)
+        # A view, not a copy, when the image is already C-contiguous (as frames from cv2 are)
+        pixels = np.ascontiguousarray(ndarray).reshape(-1)
+        ptr = self._recognize_raw_image(self.vehicleclassifier_pointer, country, pixels, bpp, img_w, img_h, roi)
 
-        json_data = ctypes.cast(ptr, ctypes.c_char_p).value
-        json_data = _convert_from_charp(json_data)
-        response_obj = json.loads(json_data)
-        self._free_json_mem_func(ctypes.c_void_p(ptr))
-        return response_obj
+        return self._finish_recognition(ptr)
 
     def set_top_n(self, topn):
         """
@@ -242,7 +316,7 @@ class VehicleClassifier:
         :param topn: An integer that represents the number of returned results.
         :return: None
         """
-        self._set_top_n_func(self.vehicleclassifier_pointer, topn)
+        self._fns.set_top_n(self.vehicleclassifier_pointer, topn)
 
     def unload(self):
         """
@@ -250,7 +324,5 @@ class VehicleClassifier:
 
         :return: None
         """
-        if self.vehicleclassifier_pointer is not None:
-            self._vehicleclassifierpy_lib.vehicleclassifier_cleanup(self.vehicleclassifier_pointer)
-
-            self.vehicleclassifier_pointer = None
\ No newline at end of file
+        self._finalizer()
+        self.vehicleclassifier_pointer = None
\ No newline at end of file